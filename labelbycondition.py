@@ -1,4 +1,5 @@
-from typing import Any, Dict, List, Tuple
+import functools
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import pyarrow as pa
@@ -9,69 +10,184 @@ from cjwmodule.util.colnames import gen_unique_clean_colnames_and_warn
 __all__ = ["render"]
 
 
-def _generate_label_column(
-    arrow_table: pa.Table, label_specs: List[Dict[str, Any]]
-) -> Tuple[pa.DictionaryArray, List]:
-    errors = []
-    nulls = np.ones(len(arrow_table), np.bool_)  # start all-null
-    values = []  # first value will have index=0
-    indices = np.zeros(len(arrow_table), np.int32)  # start all-0 (but they're null)
+MAX_OUTPUT_BATCH_SIZE = 64 * 1024  # rows per record batch that render() writes
+LABEL_COLUMN_TYPE = pa.dictionary(pa.int32(), pa.utf8())
 
-    for label_spec in label_specs:
-        value = label_spec["value"]
-        condition = label_spec["condition"]
 
-        if condition is None:
-            continue
+def _mask_to_bitmap(mask: pa.ChunkedArray) -> np.ndarray:
+    """Pack a no-nulls boolean mask into an Arrow-style (LSB-first) bitmap.
+
+    When `mask` is a single byte-aligned chunk, the result is a zero-copy view
+    of Arrow's own bitmap. Bits past `len(mask)` are undefined: AND the result
+    with a bitmap whose trailing bits are zero.
+    """
+    n_bytes = (len(mask) + 7) // 8
+    if mask.num_chunks == 1 and mask.chunk(0).offset % 8 == 0:
+        array = mask.chunk(0)
+        return np.frombuffer(
+            array.buffers()[1], np.uint8, count=n_bytes, offset=array.offset // 8
+        )
+    else:
+        return np.packbits(np.asarray(mask.to_numpy(), np.bool_), bitorder="little")
+
+
+@functools.lru_cache(maxsize=64)
+def _strings_to_array(values: Tuple[str, ...]) -> pa.StringArray:
+    """Build a utf8 array from UTF-8 bytes we encode ourselves.
+
+    This skips pyarrow's per-object conversion of Python lists. Arrow arrays
+    are immutable, so re-renders with the same values share one dictionary.
+    """
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, np.int32)
+    np.cumsum([len(b) for b in encoded], dtype=np.int32, out=offsets[1:])
+    return pa.Array.from_buffers(
+        pa.utf8(),
+        len(encoded),
+        [None, pa.py_buffer(offsets), pa.py_buffer(b"".join(encoded))],
+    )
 
-        try:
-            mask = condition_to_mask(arrow_table, condition)
-        except ConditionError as err:
-            errors.extend(
-                [
-                    i18n.trans(
-                        "error.invalidRegex",
-                        "Invalid regular expression “{pattern}”: {message}",
-                        {"value": e.pattern, "message": e.msg},
-                    )
-                    for e in err.errors
-                ]
-            )
-            continue
 
-        np_mask = mask.to_numpy() & nulls  # only overwrite nulls
+def _condition_error_to_i18n(err: ConditionError) -> List[i18n.I18nMessage]:
+    return [
+        i18n.trans(
+            "error.invalidRegex",
+            "Invalid regular expression “{pattern}”: {message}",
+            {"value": e.pattern, "message": e.msg},
+        )
+        for e in err.errors
+    ]
+
+
+def _condition_errors(
+    empty_table: pa.Table, condition: Dict[str, Any]
+) -> List[i18n.I18nMessage]:
+    """Evaluate `condition` on `empty_table`, to find invalid regexes.
+
+    `empty_table` should come from `schema.empty_table()`: its dictionary
+    columns have empty dictionaries, so this only compiles the regexes. (A
+    zero-row slice keeps the whole dictionary, and cjwmodule would match
+    every dictionary value.)
+    """
+    try:
+        condition_to_mask(empty_table, condition)
+    except ConditionError as err:
+        return _condition_error_to_i18n(err)
+    return []
+
+
+def _value_index(value: str, value_to_index: Dict[str, int]) -> int:
+    """Find `value` in `value_to_index`, adding it if it's new."""
+    index = value_to_index.get(value)  # more rows for an existing label?
+    if index is None:
+        index = len(value_to_index)  # new label -- first one is index=0
+        value_to_index[value] = index
+    return index
+
+
+def _label_batch(
+    arrow_table: pa.Table,
+    label_specs: List[Dict[str, Any]],
+    value_to_index: Dict[str, int],
+) -> pa.Array:
+    """Compute int32 label indices for `arrow_table`; null means "no label".
+
+    Add newly-used values to `value_to_index`, so indices are consistent
+    across calls. Every condition in `label_specs` must be valid.
+
+    Masks stay packed: we AND Arrow's own bitmap buffers (viewed zero-copy)
+    with a packed bitmap of unlabeled rows, one bit per row. Only a label's
+    newly-applied rows are unpacked, to write its index. (NumPy operators on
+    the views beat `pyarrow.compute.and_()`/`if_else()`, which allocate a new
+    array per label.)
+    """
+    n_rows = len(arrow_table)
+    # Packed bitmap of rows we haven't labeled yet (trailing bits are zero)
+    unlabeled = np.packbits(np.ones(n_rows, np.bool_), bitorder="little")
+    indices = np.zeros(n_rows, np.int32)  # start all-0 (but they're null)
+
+    for label_spec in label_specs:
+        mask = condition_to_mask(arrow_table, label_spec["condition"])
+        applied = _mask_to_bitmap(mask) & unlabeled  # only overwrite nulls
 
-        if not np.any(np_mask):
+        if not applied.any():
             # This label will apply to zero rows, because higher-priority labels
             # were already written and/or the condition didn't match.
             continue
 
-        try:
-            index = values.index(value)  # more rows for an existing label
-        except ValueError:
-            index = len(values)  # new label -- first one is index=0
-            values.append(value)
+        index = _value_index(label_spec["value"], value_to_index)
+        unlabeled ^= applied  # applied is a subset of unlabeled
+        np_mask = np.unpackbits(applied, count=n_rows, bitorder="little")
+        np.putmask(indices, np_mask, index)
 
-        nulls[np_mask] = False
-        if index > 0:  # cute, premature optimization: no need to set index=0
-            indices[np_mask] = index
+        if not unlabeled.any():
+            break  # every row has a label; later labels can't apply
 
+    # Arrow validity bitmaps are 1=valid, so `~unlabeled` is our validity bitmap
+    return pa.Array.from_buffers(
+        pa.int32(), n_rows, [pa.py_buffer(~unlabeled), pa.py_buffer(indices)]
+    )
+
+
+def _generate_label_column(
+    arrow_table: pa.Table, label_specs: List[Dict[str, Any]]
+) -> Tuple[Optional[pa.ChunkedArray], List]:
+    # Find invalid regexes once, up front, so batches never see one. Batches
+    # still compile each regex once per input chunk: condition_to_mask() only
+    # accepts condition dicts.
+    empty_table = arrow_table.schema.empty_table()
+    errors = []
+    valid_label_specs = []
+    for label_spec in label_specs:
+        if label_spec["condition"] is None:
+            continue
+
+        condition_errors = _condition_errors(empty_table, label_spec["condition"])
+        if condition_errors:
+            errors.extend(condition_errors)
+        else:
+            valid_label_specs.append(label_spec)
+    if errors:
+        # render() won't output a table, so don't spend time computing one
+        return None, errors
+
+    if arrow_table.num_rows == 0:
+        return pa.chunked_array([], LABEL_COLUMN_TYPE), []
+
+    # value => dictionary index. Dicts keep insertion order, so the keys are
+    # the dictionary values, in order: first value will have index=0.
+    value_to_index: Dict[str, int] = {}
+
+    # Label one input chunk at a time, so each chunk's bitmap and indices are
+    # smaller than the whole table's. All chunks share one dictionary.
+    #
+    # Don't split chunks further: a slice of a dictionary column keeps the
+    # whole dictionary, and cjwmodule matches text against every dictionary
+    # value -- so each extra slice would repeat that work.
+    batch_indices = [
+        _label_batch(pa.Table.from_batches([batch]), valid_label_specs, value_to_index)
+        for batch in arrow_table.to_batches()
+    ]
+
+    dictionary = _strings_to_array(tuple(value_to_index))
     return (
-        pa.DictionaryArray.from_arrays(
-            indices, pa.array(values, pa.utf8()), mask=nulls
+        pa.chunked_array(
+            [
+                pa.DictionaryArray.from_arrays(indices, dictionary, safe=False)
+                for indices in batch_indices
+            ],
+            LABEL_COLUMN_TYPE,
         ),
         errors,
     )
 
 
 def _add_column(
-    arrow_table: pa.Table, name: str, data: pa.Array, *, settings
+    arrow_table: pa.Table, name: str, data: pa.ChunkedArray, *, settings
 ) -> [pa.Table, List[str]]:
-    if name in arrow_table.column_names:
-        return (
-            arrow_table.set_column(arrow_table.column_names.index(name), name, data),
-            [],
-        )
+    index = arrow_table.schema.get_field_index(name)  # -1 if missing
+    if index >= 0:
+        return arrow_table.set_column(index, name, data), []
     else:
         [clean_colname], errors = gen_unique_clean_colnames_and_warn(
             [name], existing_names=arrow_table.column_names, settings=settings
@@ -79,10 +195,16 @@ def _add_column(
         return arrow_table.append_column(clean_colname, data), errors
 
 
+def _write_table(output_path, arrow_table: pa.Table) -> None:
+    """Write `arrow_table` one record batch at a time."""
+    with pa.ipc.RecordBatchFileWriter(output_path, arrow_table.schema) as writer:
+        for batch in arrow_table.to_batches(max_chunksize=MAX_OUTPUT_BATCH_SIZE):
+            writer.write_batch(batch)
+
+
 def render(arrow_table: pa.Table, params, output_path, *, settings, **kwargs):
     if not params["colname"]:
-        with pa.ipc.RecordBatchFileWriter(output_path, arrow_table.schema) as writer:
-            writer.write_table(arrow_table)
+        _write_table(output_path, arrow_table)
         return []  # no errors
 
     label_column, errors = _generate_label_column(arrow_table, params["labels"])
@@ -95,6 +217,5 @@ def render(arrow_table: pa.Table, params, output_path, *, settings, **kwargs):
     )
     errors.extend(add_column_errors)
 
-    with pa.ipc.RecordBatchFileWriter(output_path, output_table.schema) as writer:
-        writer.write_table(output_table)
+    _write_table(output_path, output_table)
     return errors
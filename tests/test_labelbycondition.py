@@ -3,10 +3,12 @@ from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 import pyarrow as pa
+import pytest
 from cjwmodule.i18n import I18nMessage
 from cjwmodule.testing.i18n import cjwmodule_i18n_message, i18n_message
 from cjwmodule.util.colnames import DefaultSettings, Settings
 
+import labelbycondition
 from labelbycondition import render
 
 
@@ -63,6 +65,29 @@ def test_empty_table():
     )
 
 
+def test_empty_table_regex_error():
+    _test_render(
+        pa.table({"A": pa.array([], pa.utf8())}),
+        {
+            "colname": "B",
+            "labels": [
+                {
+                    "value": "a",
+                    "condition": dict(
+                        operation="text_is",
+                        column="A",
+                        value="[",
+                        isCaseSensitive=False,
+                        isRegex=True,
+                    ),
+                }
+            ],
+        },
+        None,
+        [i18n_message("error.invalidRegex", {"value": "[", "message": "missing ]: ["})],
+    )
+
+
 def test_ignore_null_condition():
     _test_render(
         pa.table({"A": [1, 2, 3]}),
@@ -185,6 +210,103 @@ def test_regex_errors():
     )
 
 
+def test_regex_error_after_all_rows_labeled():
+    _test_render(
+        pa.table({"A": ["a", "b"]}),
+        {
+            "colname": "B",
+            "labels": [
+                {"value": "a", "condition": dict(operation="cell_is_null", column="A")},
+                {
+                    "value": "b",
+                    "condition": dict(
+                        operation="not",
+                        condition=dict(operation="cell_is_null", column="A"),
+                    ),
+                },
+                {
+                    "value": "c",
+                    "condition": dict(
+                        operation="text_is",
+                        column="A",
+                        value="[",
+                        isCaseSensitive=False,
+                        isRegex=True,
+                    ),
+                },
+            ],
+        },
+        None,
+        [i18n_message("error.invalidRegex", {"value": "[", "message": "missing ]: ["})],
+    )
+
+
+@pytest.mark.parametrize("n_earlier_labels", [0, 7, 8])
+def test_stop_evaluating_conditions_after_all_rows_labeled(
+    monkeypatch, n_earlier_labels
+):
+    row_counts = []
+    real_condition_to_mask = labelbycondition.condition_to_mask
+
+    def condition_to_mask(table, condition):
+        row_counts.append(len(table))
+        return real_condition_to_mask(table, condition)
+
+    monkeypatch.setattr(labelbycondition, "condition_to_mask", condition_to_mask)
+    _test_render(
+        pa.table({"A": [1, 2, 3]}),
+        {
+            "colname": "B",
+            "labels": (
+                [{"value": "x", "condition": EQ("A", 4)}] * n_earlier_labels
+                + [{"value": "a", "condition": GT("A", 0)}]
+                + [{"value": "b", "condition": EQ("A", 2)}] * 9
+            ),
+        },
+        pa.table({"A": [1, 2, 3], "B": pa.array(["a", "a", "a"]).dictionary_encode()}),
+    )
+    # Every condition is validated on zero rows; only the first
+    # n_earlier_labels + 1 are evaluated on the table's rows
+    assert sum(1 for n in row_counts if n > 0) == n_earlier_labels + 1
+
+
+def test_validate_regex_without_dictionary_values(monkeypatch):
+    dictionary_sizes = []
+    real_condition_to_mask = labelbycondition.condition_to_mask
+
+    def condition_to_mask(table, condition):
+        if len(table) == 0:
+            dictionary_sizes.extend(len(c.dictionary) for c in table["A"].chunks)
+        return real_condition_to_mask(table, condition)
+
+    monkeypatch.setattr(labelbycondition, "condition_to_mask", condition_to_mask)
+    _test_render(
+        pa.table({"A": pa.array(["a", "b", "c"]).dictionary_encode()}),
+        {
+            "colname": "B",
+            "labels": [
+                {
+                    "value": "x",
+                    "condition": dict(
+                        operation="text_is",
+                        column="A",
+                        value="b",
+                        isCaseSensitive=True,
+                        isRegex=True,
+                    ),
+                }
+            ],
+        },
+        pa.table(
+            {
+                "A": pa.array(["a", "b", "c"]).dictionary_encode(),
+                "B": pa.array([None, "x", None]).dictionary_encode(),
+            }
+        ),
+    )
+    assert dictionary_sizes == [0]
+
+
 def test_overwrite_column():
     _test_render(
         pa.table({"A": [1, 2, 3], "B": [2, 3, 4]}),
@@ -217,3 +339,135 @@ def test_clean_colname():
             )
         ],
     )
+
+
+def test_multiple_chunks():
+    _test_render(
+        pa.Table.from_batches(
+            [
+                pa.record_batch([pa.array([1, 2, 3])], ["A"]),
+                pa.record_batch([pa.array([2, 4, 2, 5, 6, 2, 7, 8, 2])], ["A"]),
+            ]
+        ),
+        {
+            "colname": "B",
+            "labels": [
+                {"value": "a", "condition": EQ("A", 2)},
+                {"value": "b", "condition": GT("A", 6)},
+            ],
+        },
+        pa.table(
+            {
+                "A": [1, 2, 3, 2, 4, 2, 5, 6, 2, 7, 8, 2],
+                "B": pa.array(
+                    [None, "a", None, "a", None, "a", None, None, "a", "b", "b", "a"]
+                ).dictionary_encode(),
+            }
+        ),
+    )
+
+
+def test_dictionary_column_batches_share_dictionary(monkeypatch):
+    # Label whole input chunks: re-splitting them would make cjwmodule match
+    # each slice's (full) dictionary again, once per slice.
+    monkeypatch.setattr(labelbycondition, "MAX_OUTPUT_BATCH_SIZE", 2)
+    dictionary = pa.array(["w", "x", "y", "z"])
+    table = pa.Table.from_batches(
+        [
+            pa.record_batch(
+                [pa.DictionaryArray.from_arrays([1, 2, 1, 3], dictionary)], ["A"]
+            ),
+            pa.record_batch(
+                [pa.DictionaryArray.from_arrays([3, 2, 0], dictionary)], ["A"]
+            ),
+        ]
+    )
+    params = {
+        "colname": "B",
+        "labels": [
+            {
+                "value": "a",
+                "condition": dict(
+                    operation="text_is",
+                    column="A",
+                    value="y",
+                    isCaseSensitive=True,
+                    isRegex=True,
+                ),
+            },
+            {
+                "value": "b",  # first used in the second batch
+                "condition": dict(
+                    operation="text_is",
+                    column="A",
+                    value="w",
+                    isCaseSensitive=True,
+                    isRegex=False,
+                ),
+            },
+        ],
+    }
+
+    label_column, errors = labelbycondition._generate_label_column(
+        table, params["labels"]
+    )
+    assert errors == []
+    assert label_column.num_chunks == 2  # one per input chunk
+    for chunk in label_column.chunks:
+        assert chunk.dictionary.to_pylist() == ["a", "b"]
+
+    _test_render(
+        table,
+        params,
+        pa.table(
+            {
+                "A": pa.DictionaryArray.from_arrays([1, 2, 1, 3, 3, 2, 0], dictionary),
+                "B": pa.array(
+                    [None, "a", None, None, None, "a", "b"]
+                ).dictionary_encode(),
+            }
+        ),
+    )
+
+
+def test_sliced_table_partial_bitmap_bytes():
+    # 11 rows, starting 3 rows into their buffers: bitmaps end mid-byte
+    table = pa.table({"A": list(range(14))}).slice(3, 11)
+    _test_render(
+        table,
+        {
+            "colname": "B",
+            "labels": [
+                {"value": "a", "condition": GT("A", 11)},
+                {"value": "b", "condition": GT("A", 4)},
+            ],
+        },
+        pa.table(
+            {
+                "A": list(range(3, 14)),
+                "B": pa.array(
+                    [None, None, "b", "b", "b", "b", "b", "b", "b", "a", "a"]
+                ).dictionary_encode(),
+            }
+        ),
+    )
+
+
+def test_many_labels():
+    _test_render(
+        pa.table({"A": [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]}),
+        {
+            "colname": "B",
+            "labels": [
+                {"value": str(i % 3), "condition": EQ("A", i)} for i in range(12, 1, -1)
+            ],
+        },
+        pa.table(
+            {
+                "A": [1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+                "B": pa.array(
+                    [None, "2", "0", "1", "2", "0", "1", "2", "0", "1"]
+                ).dictionary_encode(),
+            }
+        ),
+    )